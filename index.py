@@ -2,37 +2,55 @@
 # -*- coding: utf-8 -*-
 
 import json
-import re
+import orjson
 import os
-from jinja2 import Environment, FileSystemLoader
+import re
+import functools
+from collections import deque
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 import textfsm
-from json2xml import json2xml
+from xml.sax.saxutils import escape
 import jinja_filters
 import csv
 import argparse
-
-
-def process_fsms(config_text):
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+# Lambda can only write to /tmp, locally keep the cache next to the templates
+_JINJA_CACHE_DIR = (
+    "/tmp/jinja_cache"
+    if "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+    else "app/.jinja_cache"
+)
+os.makedirs(_JINJA_CACHE_DIR, exist_ok=True)
+_bytecode_cache = FileSystemBytecodeCache(
+    directory=_JINJA_CACHE_DIR, pattern="__jinja2_%s.cache"
+)
+
+# The parser templates do not change at runtime, so the directory is only listed once
+_PARSER_FSMS = tuple(
+    (f[: -len(".textfsm")], f"app/parser/{f}")
+    for f in os.listdir("app/parser")
+    if f.endswith(".textfsm") and os.path.isfile(os.path.join("app/parser", f))
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_fsm(path, mtime):
     """
-    Process the FSM templates in the 'parser' directory and parse the given configuration text.
+    Load and compile a single FSM template.
+
+    The modification time is part of the cache key so an edited template is recompiled.
 
     Args:
-        config_text (str): The configuration text to be parsed.
+        path (str): The path to the FSM template.
+        mtime (float): The modification time of the FSM template.
 
     Returns:
-        dict: A dictionary with keys as FSM template names and values as parsed results.
+        TextFSM: The compiled FSM.
     """
-    result = {}
-
-    fsms = [
-        f for f in os.listdir("app/parser") if os.path.isfile(os.path.join("app/parser", f))
-    ]
-    for fsm in fsms:
-        if fsm.endswith(".textfsm"):
-            key = fsm.replace(".textfsm", "")
-            result[key] = process_fsm(f"app/parser/{fsm}", config_text)
-
-    return result
+    with open(path) as template:
+        return textfsm.TextFSM(template)
 
 
 def process_fsm(path, raw):
@@ -46,59 +64,105 @@ def process_fsm(path, raw):
     Returns:
         list: A list of dictionaries containing parsed results.
     """
-    with open(path) as template:
-        fsm = textfsm.TextFSM(template)
-        result = fsm.ParseTextToDicts(raw)
-    return result
+    fsm = _load_fsm(path, os.path.getmtime(path))
+    fsm.Reset()
+    return fsm.ParseTextToDicts(raw)
 
 
-def prune_empty_tables(tables):
-    """
-    Remove empty tables from the parsed results.
+# Tables that only need a filter applied are post-processed directly, without rendering a
+# template to JSON text and parsing it back
+_POST_PROCESSORS = {
+    # flatten all "interface remote set" rows into a single entry
+    "interface_remote_set": jinja_filters.table_flatten,
+    # merge matching "port set port" rows by port
+    "port_set_port": functools.partial(jinja_filters.merge_table_by_key, table_key="port"),
+}
 
-    Args:
-        tables (dict): A dictionary containing parsed tables.
+
+@functools.lru_cache(maxsize=None)
+def _get_parser_env():
+    """
+    Get the shared Jinja2 environment for the post-processing templates in the 'parser' directory.
 
     Returns:
-        dict: A dictionary with empty tables removed.
+        Environment: The Jinja2 environment with the custom filters registered.
     """
-    keys_to_be_removed = []
-    for key, value in tables.items():
-        if len(tables[key]) == 0:
-            keys_to_be_removed.append(key)
-    for k in keys_to_be_removed:
-        del tables[k]
+    file_loader = FileSystemLoader("app/parser")
+    env = Environment(loader=file_loader, bytecode_cache=_bytecode_cache)
+    env.filters["hyphen_range_to_list"] = jinja_filters.hyphen_range_to_list
+    env.filters["merge_table_by_key"] = jinja_filters.merge_table_by_key
+    env.filters["table_flatten"] = jinja_filters.table_flatten
+    return env
+
 
-    return tables
+def post_process_fsm(key, value):
+    """
+    Post-process a single parsed FSM table.
 
+    Args:
+        key (str): The FSM template name of the table.
+        value (list): The parsed table.
 
-def post_process_fsms(tables):
+    Returns:
+        list: The post-processed table.
+    """
+    if key in _POST_PROCESSORS:
+        return _POST_PROCESSORS[key](value)
+    if os.path.isfile(f"app/parser/{key}.json.j2"):
+        template = _get_parser_env().get_template(f"{key}.json.j2")
+        data = {"data": value}
+        parse = template.render(data)
+        return orjson.loads(parse)
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _get_env(path):
     """
-    Post-process the parsed FSM tables using Jinja2 templates.
+    Get a shared Jinja2 environment for the templates in the given directory.
+
+    Reusing the environment keeps Jinja2's compiled template cache between calls.
 
     Args:
-        tables (dict): A dictionary containing parsed tables.
+        path (str): The directory containing the Jinja2 templates.
 
     Returns:
-        dict: A dictionary with post-processed tables.
+        Environment: The Jinja2 environment for the directory.
     """
-    file_loader = FileSystemLoader("app/parser")
-    env = Environment(loader=file_loader)
-    env.filters["hyphen_range_to_list"] = jinja_filters.hyphen_range_to_list
-    env.filters["merge_table_by_key"] = jinja_filters.merge_table_by_key
-    env.filters["table_flatten"] = jinja_filters.table_flatten
+    file_loader = FileSystemLoader(path)
+    return Environment(
+        loader=file_loader,
+        trim_blocks=True,
+        lstrip_blocks=True,
+        bytecode_cache=_bytecode_cache,
+    )
 
-    result = {}
-    for key, value in tables.items():
-        if os.path.isfile(f"app/parser/{key}.json.j2"):
-            template = env.get_template(f"{key}.json.j2")
-            data = {"data": value}
-            parse = template.render(data)
-            result[key] = json.loads(parse)
-        else:
-            result[key] = value
 
-    return result
+@functools.lru_cache(maxsize=None)
+def _get_converter_layout(converter_path):
+    """
+    Load the templates of each parent directory in a converter directory.
+
+    The converter templates do not change at runtime, so the directory is only walked once.
+
+    Args:
+        converter_path (str): The path to the converter directory.
+
+    Returns:
+        dict: A dictionary with parent directory names as keys and tuples of
+        (file name, template) pairs as values.
+    """
+    layout = {}
+    parents = next(os.walk(converter_path))[1]
+    for parent in parents:
+        parent_path = f"{converter_path}/{parent}"
+        env = _get_env(parent_path)
+        layout[parent] = tuple(
+            (f, env.get_template(f))
+            for f in os.listdir(parent_path)
+            if os.path.isfile(os.path.join(parent_path, f)) and f.endswith(".j2")
+        )
+    return layout
 
 
 def convert(tables, converter, options=None):
@@ -115,35 +179,24 @@ def convert(tables, converter, options=None):
     """
     result = {}
     converter_path = f"app/converter/{converter}"
-    tables["options"] = options
-    parents = next(os.walk(converter_path))[1]
-    for parent in parents:
+    for parent, templates in _get_converter_layout(converter_path).items():
         result[parent] = []
-        # parse each jinja
-        parent_path = f"{converter_path}/{parent}"
-        jinjas = [
-            f
-            for f in os.listdir(parent_path)
-            if os.path.isfile(os.path.join(parent_path, f))
-        ]
-        for jinja in jinjas:
-            if jinja.endswith(".j2"):
-                # do jinja processing
-                file_loader = FileSystemLoader(f"{parent_path}")
-                env = Environment(
-                    loader=file_loader, trim_blocks=True, lstrip_blocks=True
-                )
-                template = env.get_template(jinja)
-                rendered = template.render(tables)
-                try:
-                    result[parent] = result[parent] + json.loads(rendered)
-                except json.decoder.JSONDecodeError:
-                    print(f"Error parsing using {jinja}")
-                    print(f"{rendered}")
-                    raise
+        # render each jinja
+        for jinja, template in templates:
+            rendered = template.render(tables, options=options)
+            try:
+                result[parent].extend(orjson.loads(rendered))
+            except orjson.JSONDecodeError:
+                print(f"Error parsing using {jinja}")
+                print(f"{rendered}")
+                raise
     return result
 
 
+# Load the default converter at import time so requests don't hit the filesystem for it
+_get_converter_layout("app/converter/default")
+
+
 def parse_input(config_text):
     """
     Parse the input configuration text and process FSMs.
@@ -154,12 +207,144 @@ def parse_input(config_text):
     Returns:
         dict: A dictionary with processed FSM tables.
     """
-    tables = process_fsms(config_text)
-    tables = prune_empty_tables(tables)
-    processed = post_process_fsms(tables)
+    processed = {}
+    # post-process each table as soon as it is parsed, empty tables are dropped
+    for key, path in _PARSER_FSMS:
+        value = process_fsm(path, config_text)
+        if value:
+            processed[key] = post_process_fsm(key, value)
     return processed
 
 
+# An XML element name, a letter or underscore followed by letters, digits, "_", "-" or "."
+_XML_NAME = re.compile(r"[^\W\d][\w.-]*\Z")
+
+
+def _xml_text(value):
+    """
+    Convert a leaf value to escaped XML text.
+
+    Args:
+        value (str, int, float, bool or None): The leaf value.
+
+    Returns:
+        str: The escaped text.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value).lower()
+    return escape(str(value), {'"': "&quot;"})
+
+
+@functools.lru_cache(maxsize=None)
+def _xml_name(key):
+    """
+    Convert a dictionary key to a valid XML element name.
+
+    Keys that can't be made valid become a "key" element carrying the original key as its
+    "name" attribute.
+
+    Args:
+        key (str): The dictionary key.
+
+    Returns:
+        str: The element name, followed by its attribute when the key was not a valid name.
+    """
+    key = str(key)
+    if _XML_NAME.match(key):
+        return key
+    if key.isdigit():
+        return f"n{key}"
+    if _XML_NAME.match(key.replace(" ", "_")):
+        return key.replace(" ", "_")
+    if ":" in key and _XML_NAME.match(key.replace(":", "")):
+        return key
+    return f'key name="{_xml_text(key)}"'
+
+
+def _emit(tag, value, depth):
+    """
+    Yield the XML fragments of a single element.
+
+    Lists repeat the parent tag (no item wrapping) and empty elements are self-closed.
+
+    Args:
+        tag (str): The element name, optionally followed by its attributes.
+        value (dict, list, str, int, float, bool or None): The element value.
+        depth (int): The indentation depth of the element.
+
+    Yields:
+        str: The XML fragments of the element.
+    """
+    indent = "\t" * depth
+    name = tag.partition(" ")[0]
+    if isinstance(value, list) and value and not isinstance(value[0], (dict, list)):
+        # a list of leaves is flattened into repeated elements
+        yield from _emit_items(tag, value, depth)
+        return
+    if isinstance(value, dict):
+        children = _emit_members(value, depth + 1)
+    elif isinstance(value, list):
+        children = _emit_items(tag, value, depth + 1)
+    else:
+        text = _xml_text(value)
+        yield f"{indent}<{tag}>{text}</{name}>\n" if text else f"{indent}<{tag}/>\n"
+        return
+    first = next(children, None)
+    if first is None:
+        yield f"{indent}<{tag}/>\n"
+        return
+    yield f"{indent}<{tag}>\n"
+    yield first
+    yield from children
+    yield f"{indent}</{name}>\n"
+
+
+def _emit_members(data, depth):
+    """
+    Yield the XML fragments of every key of a dictionary.
+
+    An "xml_container" key is not an element of its own, its contents are spliced straight into
+    the parent element (see the frame-to-cos-maps converter).
+
+    Args:
+        data (dict): The dictionary to be converted.
+        depth (int): The indentation depth of the members.
+
+    Yields:
+        str: The XML fragments of the members.
+    """
+    for key, value in data.items():
+        if key == "xml_container":
+            yield from _emit_items(key, value if isinstance(value, list) else [value], depth)
+        else:
+            yield from _emit(_xml_name(key), value, depth)
+
+
+def _emit_items(tag, items, depth):
+    """
+    Yield the XML fragments of the items of a list.
+
+    Dictionaries are merged into the parent element, leaves repeat the parent tag.
+
+    Args:
+        tag (str): The element name of the list.
+        items (list): The list to be converted.
+        depth (int): The indentation depth of the items.
+
+    Yields:
+        str: The XML fragments of the items.
+    """
+    for item in items:
+        if isinstance(item, dict):
+            yield from _emit_members(item, depth)
+        elif isinstance(item, (list, bool)) or item is None:
+            yield from _emit("item", item, depth)
+        else:
+            yield from _emit(tag, item, depth)
+
+
 def json_2_xml(data):
     """
     Convert JSON data to XML format.
@@ -170,12 +355,7 @@ def json_2_xml(data):
     Returns:
         str: The XML representation of the JSON data.
     """
-    xml = json2xml.Json2xml(
-        data, wrapper="config", attr_type=False, item_wrap=False
-    ).to_xml()
-    replaced = re.sub(r"<xml_container>", "", xml)
-    replaced = re.sub(r"</xml_container>", "", replaced)
-    return replaced
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + "".join(_emit("config", data, 0))
 
 
 def handler(event, context):
@@ -189,11 +369,15 @@ def handler(event, context):
     Returns:
         dict: The response containing the status code, headers, and body with the converted results.
     """
-    print("received event:")
-    print(json.dumps(event))
-    body = json.loads(event["body"])
-    print("received body:")
-    print(json.dumps(body))
+    # dumping the whole payload copies the config twice, only do it when debugging
+    debug = bool(os.environ.get("DEBUG"))
+    if debug:
+        print("received event:")
+        print(json.dumps(event))
+    body = orjson.loads(event["body"])
+    if debug:
+        print("received body:")
+        print(json.dumps(body))
 
     if not body:
         return {"statusCode": 400, "body": json.dumps("Missing body")}
@@ -204,7 +388,8 @@ def handler(event, context):
 
     converted = convert(tables, "default", options)
     xml = json_2_xml(converted)
-    print(f"returning xml: {xml}")
+    if debug:
+        print(f"returning xml: {xml}")
 
     result = {"message": "success", "xml": xml, "tables": tables}
     return {
@@ -214,7 +399,7 @@ def handler(event, context):
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Methods": "OPTIONS,POST,GET",
         },
-        "body": json.dumps(result),
+        "body": orjson.dumps(result).decode(),
     }
 
 
@@ -230,29 +415,108 @@ def json_2_saos(input):
     """
     out = []
 
-    # I need to process every command in a nested way also take on consideration the lists
-    def reduce(nested_json, cmd="", name=""):
-        # cmd is the previous build
+    # Every command is the path of keys down to a leaf, prefixed by the "name" of each dict on
+    # the way. Walk it depth first with an explicit stack, keeping the path as a tuple of tokens.
+    stack = deque([(input, ("config",))])
+    while stack:
+        nested_json, cmd = stack.pop()
         if type(nested_json) is dict:
             # The name is the key element and must be in every command in the first place
-            if "name" in nested_json.keys():
-                name = nested_json["name"] + " "
-                del nested_json["name"]
-            for a in nested_json:
-                reduce(nested_json[a], cmd + name + a + " ")
+            if "name" in nested_json:
+                cmd = cmd + (nested_json["name"],)
+            children = [(v, cmd + (k,)) for k, v in nested_json.items() if k != "name"]
+            stack.extend(reversed(children))
         elif type(nested_json) is list:
-            for a in nested_json:
-                reduce(a, cmd)
+            stack.extend((a, cmd) for a in reversed(nested_json))
         else:
-            out.append(cmd[:-1] + " " + nested_json)
-
-    reduce(input, "config ")
+            out.append(" ".join(cmd) + " " + nested_json)
 
     strout = "\n".join(out)
 
     return strout
 
 
+def write_file(data, destination):
+    """
+    Write data to a file at the specified destination.
+
+    Args:
+        data (str): The data to be written.
+        destination (str): The file path where the data will be written.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with open(destination, "w") as file:
+        file.write(data)
+
+
+def generate_csv(filename, tables):
+    """
+    Generate CSV files from the parsed tables.
+
+    Args:
+        filename (str): The name of the input file.
+        tables (dict): A dictionary containing parsed tables.
+
+    Returns:
+        int: The total number of commands parsed.
+    """
+    counter = 0
+    filename_short = filename.replace(".saos", "").replace("configs/", "")
+    os.makedirs(f"app/assets/{filename_short}", exist_ok=True)
+    for key, value in tables.items():
+
+        header = []
+        for k, v in value[0].items():
+            header.append(k)
+        with open(
+            f"app/assets/{filename_short}/{key}.csv", "w", newline=""
+        ) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            writer.writerows([x.get(h, "") for h in header] for x in value)
+            counter += len(value)
+    return counter
+
+
+def _process_one(file, options):
+    """
+    Parse, convert and write the outputs of a single input file.
+
+    Runs in a worker process, so only the counters are returned.
+
+    Args:
+        file (str): The name of the input file in the 'saos6-configs' directory.
+        options (dict): Additional options for conversion.
+
+    Returns:
+        tuple: The file name, the number of commands parsed and the total number of commands.
+    """
+    config_text = open(f"saos6-configs/{file}").read()
+    cmds_total = sum(
+        1 for line in config_text.splitlines() if line.strip()
+    )  # Num of commands = num of not empty lines
+    tables = parse_input(config_text)
+    cmds_parsed = generate_csv(
+        file, tables
+    )  # Each line generated in the CSV is going to be a command that was parsed TODO
+    # print(f"converting input for {file}")
+    converted = convert(tables, "default", options)
+    xml = json_2_xml(converted)
+    saos = json_2_saos(converted)
+    # print(f"writing output for {file}")
+    filename = file.replace(".saos", "")
+    write_file(
+        orjson.dumps(
+            converted, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        ).decode(),
+        f"app/assets/{filename}/{filename}.json",
+    )
+    write_file(xml, f"output/xml/{filename}.xml")
+    write_file(saos, f"output/saos10/{filename}.saos")
+    # print(f"done for {file}")
+    return file, cmds_parsed, cmds_total
+
+
 if __name__ == "__main__":
     # Run local conversion and tests
 
@@ -286,80 +550,16 @@ if __name__ == "__main__":
                 ]
         return files
 
-    def write_file(data, destination):
-        """
-        Write data to a file at the specified destination.
-
-        Args:
-            data (str): The data to be written.
-            destination (str): The file path where the data will be written.
-        """
-        os.makedirs(os.path.dirname(destination), exist_ok=True)
-        with open(destination, "w") as file:
-            file.write(data)
-
-    def generate_csv(filename, tables):
-        """
-        Generate CSV files from the parsed tables.
-
-        Args:
-            filename (str): The name of the input file.
-            tables (dict): A dictionary containing parsed tables.
-
-        Returns:
-            int: The total number of commands parsed.
-        """
-        counter = 0
-        for key, value in tables.items():
-
-            header = []
-            for k, v in value[0].items():
-                header.append(k)
-            filename_short = filename.replace(".saos", "").replace("configs/", "")
-            os.makedirs(f"app/assets/{filename_short}", exist_ok=True)
-            with open(
-                f"app/assets/{filename_short}/{key}.csv", "w", newline=""
-            ) as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=header)
-                writer.writeheader()
-                for x in value:
-                    counter += 1
-                    writer.writerow(x)
-        return counter
-
     files = get_files_by_extension_in_directory("saos6-configs", include_examples=args.examples)
     f = open(
         f"app/converter/default/options.json",
     )
     options = json.load(f)
-    cmds_total = 0
-    cmds_converted = 0
-    for file in files:
-        print("#" * 30)
-        print(f"Parsing input {file}")
-        config_text = open(f"saos6-configs/{file}").read()
-        cmds_total = len(
-            [ele for ele in config_text.replace(" ", "").split("\n") if ele != ""]
-        )  # Num of commands = num of not empty lines
-        tables = parse_input(config_text)
-        cmds_parsed = generate_csv(
-            file, tables
-        )  # Each line generated in the CSV is going to be a command that was parsed TODO
-        # print(f"converting input for {file}")
-        converted = convert(tables, "default", options)
-        xml = json_2_xml(converted)
-        saos = json_2_saos(converted)
-        # print(f"writing output for {file}")
-        filename = file.replace(".saos", "")
-        os.makedirs(f"app/assets/{filename}", exist_ok=True)
-        write_file(
-            json.dumps(converted, indent=2, sort_keys=True),
-            f"app/assets/{filename}/{filename}.json",
-        )
-        os.makedirs(f"output/xml/", exist_ok=True)
-        os.makedirs(f"output/saos10/", exist_ok=True)
-        write_file(xml, f"output/xml/{filename}.xml")
-        write_file(saos, f"output/saos10/{filename}.saos")
-        # print(f"done for {file}")
-        print(f"{round((cmds_parsed/cmds_total)*100,2)}% parse rate")
-        print(f"{cmds_parsed} commands were recognized out of {cmds_total}")
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for file, cmds_parsed, cmds_total in executor.map(
+            _process_one, files, itertools.repeat(options)
+        ):
+            print("#" * 30)
+            print(f"Parsing input {file}")
+            print(f"{round((cmds_parsed/cmds_total)*100,2)}% parse rate")
+            print(f"{cmds_parsed} commands were recognized out of {cmds_total}")
@@ -1,6 +1,6 @@
 def hyphen_range_to_list(s):
     """
-    yield each integer from a complex range string like "1-9,12, 15-20,23"
+    expand each integer from a complex range string like "1-9,12, 15-20,23"
 
     Original
 
@@ -11,19 +11,17 @@ def hyphen_range_to_list(s):
     [1, 2, 3, 4, 5, 6, 7, 8, 9, 12, 15, 16, 17, 18, 19, 20, 23]
     """
 
-    def hyphen_range(s):
-        for x in s.split(","):
-            elem = x.split("-")
-            if len(elem) == 1:  # a number
-                yield int(elem[0])
-            elif len(elem) == 2:  # a range inclusive
-                start, end = map(int, elem)
-                for i in range(start, end + 1):
-                    yield i
-            else:  # more than one hyphen
-                raise ValueError("format error in %s" % x)
-
-    return list(hyphen_range(s))
+    result = []
+    for x in s.split(","):
+        elem = x.split("-")
+        if len(elem) == 1:  # a number
+            result.append(int(elem[0]))
+        elif len(elem) == 2:  # a range inclusive
+            start, end = map(int, elem)
+            result.extend(range(start, end + 1))
+        else:  # more than one hyphen
+            raise ValueError("format error in %s" % x)
+    return result
 
 
 def merge_table_by_key(table, table_key):
@@ -47,12 +45,11 @@ def merge_table_by_key(table, table_key):
     """
     result = {}
     for row in table:
-        if row[table_key] in result:
-            for (key, value) in row.items():
-                if value != "":
-                    result[row[table_key]][key] = value
+        bucket = result.get(row[table_key])
+        if bucket is None:
+            result[row[table_key]] = dict(row)
         else:
-            result[row[table_key]] = row
+            bucket.update({key: value for key, value in row.items() if value})
     return list(result.values())
 
 
@@ -77,7 +74,8 @@ def table_flatten(table):
     for (key, value) in table[0].items():
         result[key] = ""
     for row in table:
-        for (key, value) in row.items():
-            if value != "":
+        items = row.items
+        for key, value in items():
+            if value:
                 result[key] = value
     return [result]